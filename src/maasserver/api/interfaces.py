@@ -507,7 +507,7 @@ class InterfaceHandler(OperationsHandler):
     @classmethod
     def mac_address(cls, interface):
         if interface.mac_address is not None:
-            return "%s" % interface.mac_address
+            return str(interface.mac_address)
         else:
             return None
 
@@ -9,13 +9,18 @@ __all__ = [
 ]
 
 from base64 import b64decode
-from itertools import chain
+from itertools import chain, filterfalse
 import json
 
 import bson
-from django.db.models import Prefetch
+from django.db.models import Prefetch, Q
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    set_response_etag,
+)
 from formencode.validators import Int, StringBool
 from piston3.utils import rc
 
@@ -57,6 +62,7 @@ from maasserver.models import (
     NUMANode,
     OwnerData,
     PhysicalBlockDevice,
+    Tag,
     VirtualBlockDevice,
 )
 from maasserver.models.nodeprobeddetails import get_single_probed_details
@@ -73,9 +79,18 @@ from metadataserver.enum import (
 from metadataserver.models.scriptset import get_status_from_qs
 from provisioningserver.drivers.power import UNKNOWN_POWER_TYPE
 
-NODES_SELECT_RELATED = ("bmc", "controllerinfo", "owner", "zone")
+NODES_SELECT_RELATED = ("bmc", "controllerinfo", "domain", "owner", "zone")
+
+# Large columns that none of the node representations read.
+NODES_DEFERRED = ("error_description", "instance_power_parameters")
 
 NODES_PREFETCH = [
+    # The interface parameters for each address family are never rendered.
+    # This must come before any "interface_set__" lookup below.
+    Prefetch(
+        "interface_set",
+        queryset=Interface.objects.defer("ipv4_params", "ipv6_params"),
+    ),
     "domain__dnsresource_set__ip_addresses",
     "domain__dnsresource_set__dnsdata_set",
     "domain__globaldefault_set",
@@ -148,7 +163,6 @@ NODES_PREFETCH = [
         "partitions__filesystem_set",
         queryset=Filesystem.objects.select_related("filesystem_group"),
     ),
-    "boot_interface__node",
     "boot_interface__vlan__primary_rack",
     "boot_interface__vlan__secondary_rack",
     "boot_interface__vlan__fabric__vlan_set",
@@ -177,7 +191,9 @@ NODES_PREFETCH = [
         "children_relationships__child__"
         "children_relationships__child__vlan"
     ),
-    "tags",
+    # Only the tag names are rendered. The definition is read when a tag
+    # is loaded, so it can't be deferred.
+    Prefetch("tags", queryset=Tag.objects.defer("comment", "kernel_opts")),
     "nodemetadata_set",
     "numanode_set",
 ]
@@ -196,14 +212,16 @@ def store_node_power_parameters(node, request):
     if power_type is None:
         return
 
-    power_types = get_driver_types(ignore_errors=True)
-    if len(power_types) == 0:
-        raise ClusterUnavailable(
-            "No rack controllers connected to validate the power_type."
-        )
-
-    if power_type not in list(power_types) + [UNKNOWN_POWER_TYPE]:
-        raise MAASAPIBadRequest("Bad power_type '%s'" % power_type)
+    # The unknown power type is always accepted, so there is nothing to
+    # validate it against.
+    if power_type != UNKNOWN_POWER_TYPE:
+        power_types = get_driver_types(ignore_errors=True)
+        if len(power_types) == 0:
+            raise ClusterUnavailable(
+                "No rack controllers connected to validate the power_type."
+            )
+        if power_type not in power_types:
+            raise MAASAPIBadRequest("Bad power_type '%s'" % power_type)
 
     power_parameters = request.POST.get("power_parameters", None)
     if power_parameters and not power_parameters.isspace():
@@ -219,6 +237,28 @@ def store_node_power_parameters(node, request):
     node.save()
 
 
+def prefetch_nodes_for_listing(nodes):
+    """Load `nodes`, ordered by id, with everything the node
+    representations read.
+
+    The related node parents are set as well, so no extra queries are needed
+    when the representations read back the node of their interfaces and
+    block devices.
+    """
+    nodes = nodes.select_related(*NODES_SELECT_RELATED)
+    nodes = nodes.defer(*NODES_DEFERRED)
+    nodes = prefetch_queryset(nodes, NODES_PREFETCH).order_by("id")
+    for node in nodes:
+        for interface in node.interface_set.all():
+            interface.node = node
+        for block_device in node.blockdevice_set.all():
+            block_device.node = node
+        boot_interface = node.boot_interface
+        if boot_interface is not None and boot_interface.node_id == node.id:
+            boot_interface.node = node
+    return nodes
+
+
 def filtered_nodes_list_from_request(request, model=None):
     """List Nodes visible to the user, optionally filtered by criteria.
 
@@ -246,7 +286,7 @@ def filtered_nodes_list_from_request(request, model=None):
 
     match_macs = get_optional_list(request.GET, "mac_address")
     if match_macs is not None:
-        invalid_macs = [mac for mac in match_macs if MAC_RE.match(mac) is None]
+        invalid_macs = list(filterfalse(MAC_RE.match, match_macs))
         if len(invalid_macs) != 0:
             raise MAASAPIValidationError(
                 "Invalid MAC address(es): %s" % ", ".join(invalid_macs)
@@ -254,40 +294,45 @@ def filtered_nodes_list_from_request(request, model=None):
 
     if model is None:
         model = Node
-    # Fetch nodes and apply filters.
-    nodes = model.objects.get_nodes(
-        request.user, NodePermission.view, ids=match_ids
-    )
+    # Build all the filters into one Q so they're applied in one go.
+    query = Q()
     if match_macs is not None:
-        nodes = nodes.filter(interface__mac_address__in=match_macs)
+        query &= Q(interface__mac_address__in=match_macs)
     match_hostnames = get_optional_list(request.GET, "hostname")
     if match_hostnames is not None:
-        nodes = nodes.filter(hostname__in=match_hostnames)
+        query &= Q(hostname__in=match_hostnames)
     match_domains = get_optional_list(request.GET, "domain")
     if match_domains is not None:
-        nodes = nodes.filter(domain__name__in=match_domains)
+        query &= Q(domain__name__in=match_domains)
     match_zone_name = request.GET.get("zone", None)
     if match_zone_name is not None:
-        nodes = nodes.filter(zone__name=match_zone_name)
+        query &= Q(zone__name=match_zone_name)
     match_pool_name = request.GET.get("pool", None)
     if match_pool_name is not None:
-        nodes = nodes.filter(pool__name=match_pool_name)
+        query &= Q(pool__name=match_pool_name)
     match_agent_name = request.GET.get("agent_name", None)
     if match_agent_name is not None:
-        nodes = nodes.filter(agent_name=match_agent_name)
-
+        query &= Q(agent_name=match_agent_name)
+    # Fetch nodes and apply filters. When only ids are given there is
+    # nothing more to add on top of the permission check.
+    nodes = model.objects.get_nodes(
+        request.user, NodePermission.view, ids=match_ids
+    )
+    if query:
+        nodes = nodes.filter(query)
     return nodes.order_by("id")
 
 
 def is_registered(request, ignore_statuses=None):
     """Used by both `NodesHandler` and `AnonNodesHandler`."""
     mac_address = get_mandatory_param(request.GET, "mac_address")
-    interfaces = Interface.objects.filter(mac_address=mac_address)
-    interfaces = interfaces.exclude(node__isnull=True)
     if ignore_statuses is None:
         ignore_statuses = [NODE_STATUS.RETIRED]
-    interfaces = interfaces.exclude(node__status__in=ignore_statuses)
-    return interfaces.exists()
+    return Interface.objects.filter(
+        ~Q(node__status__in=ignore_statuses),
+        mac_address=mac_address,
+        node__isnull=False,
+    ).exists()
 
 
 def get_cached_script_results(node):
@@ -300,6 +345,7 @@ def get_cached_script_results(node):
         )
         node._cached_commissioning_script_results = []
         node._cached_testing_script_results = []
+        node._cached_testing_script_results_by_hardware_type = by_type = {}
         for script_result in node._cached_script_results:
             if (
                 script_result.script_set.result_type
@@ -318,10 +364,25 @@ def get_cached_script_results(node):
                 node._cached_commissioning_script_results.append(script_result)
             elif script_result.script_set.result_type == RESULT_TYPE.TESTING:
                 node._cached_testing_script_results.append(script_result)
+                # Bucket the testing results by hardware type once, rather
+                # than filtering them again for each hardware test status.
+                by_type.setdefault(
+                    script_result.script.hardware_type, []
+                ).append(script_result)
 
     return node._cached_script_results
 
 
+def get_cached_test_status(node, hardware_type):
+    """Return the status of the cached testing results for `hardware_type`."""
+    get_cached_script_results(node)
+    return get_status_from_qs(
+        node._cached_testing_script_results_by_hardware_type.get(
+            hardware_type, []
+        )
+    )
+
+
 def get_script_status_name(script_status):
     for id, name in SCRIPT_STATUS_CHOICES:
         if id == script_status:
@@ -386,14 +447,7 @@ class NodeHandler(OperationsHandler):
 
     @classmethod
     def cpu_test_status(handler, node):
-        get_cached_script_results(node)
-        return get_status_from_qs(
-            [
-                script_result
-                for script_result in node._cached_testing_script_results
-                if script_result.script.hardware_type == HARDWARE_TYPE.CPU
-            ]
-        )
+        return get_cached_test_status(node, HARDWARE_TYPE.CPU)
 
     @classmethod
     def cpu_test_status_name(handler, node):
@@ -401,14 +455,7 @@ class NodeHandler(OperationsHandler):
 
     @classmethod
     def memory_test_status(handler, node):
-        get_cached_script_results(node)
-        return get_status_from_qs(
-            [
-                script_result
-                for script_result in node._cached_testing_script_results
-                if script_result.script.hardware_type == HARDWARE_TYPE.MEMORY
-            ]
-        )
+        return get_cached_test_status(node, HARDWARE_TYPE.MEMORY)
 
     @classmethod
     def memory_test_status_name(handler, node):
@@ -416,14 +463,7 @@ class NodeHandler(OperationsHandler):
 
     @classmethod
     def network_test_status(handler, node):
-        get_cached_script_results(node)
-        return get_status_from_qs(
-            [
-                script_result
-                for script_result in node._cached_testing_script_results
-                if script_result.script.hardware_type == HARDWARE_TYPE.NETWORK
-            ]
-        )
+        return get_cached_test_status(node, HARDWARE_TYPE.NETWORK)
 
     @classmethod
     def network_test_status_name(handler, node):
@@ -431,14 +471,7 @@ class NodeHandler(OperationsHandler):
 
     @classmethod
     def storage_test_status(handler, node):
-        get_cached_script_results(node)
-        return get_status_from_qs(
-            [
-                script_result
-                for script_result in node._cached_testing_script_results
-                if script_result.script.hardware_type == HARDWARE_TYPE.STORAGE
-            ]
-        )
+        return get_cached_test_status(node, HARDWARE_TYPE.STORAGE)
 
     @classmethod
     def storage_test_status_name(handler, node):
@@ -446,14 +479,7 @@ class NodeHandler(OperationsHandler):
 
     @classmethod
     def other_test_status(handler, node):
-        get_cached_script_results(node)
-        return get_status_from_qs(
-            [
-                script_result
-                for script_result in node._cached_testing_script_results
-                if script_result.script.hardware_type == HARDWARE_TYPE.NODE
-            ]
-        )
+        return get_cached_test_status(node, HARDWARE_TYPE.NODE)
 
     @classmethod
     def other_test_status_name(handler, node):
@@ -461,14 +487,7 @@ class NodeHandler(OperationsHandler):
 
     @classmethod
     def interface_test_status(handler, node):
-        get_cached_script_results(node)
-        return get_status_from_qs(
-            [
-                script_result
-                for script_result in node._cached_testing_script_results
-                if script_result.script.hardware_type == HARDWARE_TYPE.NETWORK
-            ]
-        )
+        return get_cached_test_status(node, HARDWARE_TYPE.NETWORK)
 
     @classmethod
     def interface_test_status_name(handler, node):
@@ -602,16 +621,22 @@ class NodeHandler(OperationsHandler):
             Not Found
         """
         node = get_object_or_404(self.model, system_id=system_id)
+        # The details are byte strings, which BSON already encodes as
+        # generic binary data, so they don't need wrapping in bson.Binary.
         probe_details = get_single_probed_details(node)
-        probe_details_report = {
-            name: None if data is None else bson.Binary(data)
-            for name, data in probe_details.items()
-        }
-        return HttpResponse(
-            bson.BSON.encode(probe_details_report),
+        response = HttpResponse(
+            bson.BSON.encode(probe_details),
             # Not sure what media type to use here.
             content_type="application/bson",
         )
+        # The details only change when the node is commissioned again, so
+        # let clients revalidate with If-None-Match instead of downloading
+        # them again.
+        set_response_etag(response)
+        patch_cache_control(response, private=True, no_cache=True)
+        return get_conditional_response(
+            request, etag=response["ETag"], response=response
+        )
 
     @operation(idempotent=True)
     def power_parameters(self, request, system_id):
@@ -819,16 +844,22 @@ class NodesHandler(OperationsHandler):
                 RegionControllersHandler,
             )
 
-            racks = RackControllersHandler().read(request).order_by("id")
+            # Each handler returns an evaluated queryset, already ordered by
+            # id, with its prefetched relations and related node parents set.
+            # Use those results directly; cloning them (order_by, exclude)
+            # would throw away that work and query everything again.
+            racks = RackControllersHandler().read(request)
+            rack_ids = {rack.id for rack in racks}
             nodes = list(
                 chain(
-                    DevicesHandler().read(request).order_by("id"),
-                    MachinesHandler().read(request).order_by("id"),
+                    DevicesHandler().read(request),
+                    MachinesHandler().read(request),
                     racks,
-                    RegionControllersHandler()
-                    .read(request)
-                    .exclude(id__in=racks)
-                    .order_by("id"),
+                    (
+                        region
+                        for region in RegionControllersHandler().read(request)
+                        if region.id not in rack_ids
+                    ),
                 )
             )
             return nodes
@@ -840,15 +871,7 @@ class NodesHandler(OperationsHandler):
                 request.user, NodePermission.view
             )
             nodes, _, _ = form.filter_nodes(nodes)
-            nodes = nodes.select_related(*NODES_SELECT_RELATED)
-            nodes = prefetch_queryset(nodes, NODES_PREFETCH).order_by("id")
-            # Set related node parents so no extra queries are needed.
-            for node in nodes:
-                for interface in node.interface_set.all():
-                    interface.node = node
-                for block_device in node.blockdevice_set.all():
-                    block_device.node = node
-            return nodes
+            return prefetch_nodes_for_listing(nodes)
 
     @operation(idempotent=True)
     def is_registered(self, request):
@@ -14,7 +14,7 @@ from django.db.utils import DatabaseError
 from django.http import HttpResponse
 from piston3.utils import rc
 
-from maasserver.api.nodes import NODES_PREFETCH, NODES_SELECT_RELATED
+from maasserver.api.nodes import prefetch_nodes_for_listing
 from maasserver.api.support import operation, OperationsHandler
 from maasserver.api.utils import (
     extract_oauth_key,
@@ -32,7 +32,7 @@ from maasserver.models import (
 )
 from maasserver.models.user import get_auth_tokens
 from maasserver.permissions import NodePermission
-from maasserver.utils.orm import get_one, prefetch_queryset
+from maasserver.utils.orm import get_one
 
 
 def check_rack_controller_access(request, rack_controller):
@@ -163,14 +163,7 @@ class TagHandler(OperationsHandler):
         nodes = model.objects.get_nodes(
             request.user, NodePermission.view, from_nodes=tag.node_set.all()
         )
-        nodes = nodes.select_related(*NODES_SELECT_RELATED)
-        nodes = prefetch_queryset(nodes, NODES_PREFETCH).order_by("id")
-        # Set related node parents so no extra queries are needed.
-        for node in nodes:
-            for interface in node.interface_set.all():
-                interface.node = node
-            for block_device in node.blockdevice_set.all():
-                block_device.node = node
+        nodes = prefetch_nodes_for_listing(nodes)
         return [node.as_self() for node in nodes]
 
     @operation(idempotent=True)
@@ -173,6 +173,14 @@ class TestStoreNodeParameters(APITestCase.ForUser):
             mock_get_driver_types, MockCalledOnceWith(ignore_errors=True)
         )
 
+    def test_unknown_power_type_skips_driver_lookup(self):
+        mock_get_driver_types = self.patch(nodes_module, "get_driver_types")
+        self.request.POST = {"power_type": ""}
+        store_node_power_parameters(self.node, self.request)
+        self.assertEqual("", self.node.power_type)
+        self.assertThat(mock_get_driver_types, MockNotCalled())
+        self.save.assert_called_once_with()
+
     def test_power_type_not_given(self):
         # When power_type is not specified, nothing happens.
         self.request.POST = {}
@@ -471,6 +471,33 @@ class TestGetDetails(APITestCase.ForUser):
             {"lshw": lshw_result.stdout, "lldp": None}, self.get_details(node)
         )
 
+    def test_GET_returns_not_modified_when_etag_matches(self):
+        node = factory.make_Node()
+        self.make_lshw_result(node)
+        url = reverse("node_handler", args=[node.system_id])
+        response = self.client.get(url, {"op": "details"})
+        self.assertEqual(http.client.OK, response.status_code)
+        response = self.client.get(
+            url, {"op": "details"}, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(http.client.NOT_MODIFIED, response.status_code)
+        self.assertEqual(b"", response.content)
+
+    def test_GET_returns_details_when_etag_is_stale(self):
+        node = factory.make_Node()
+        url = reverse("node_handler", args=[node.system_id])
+        response = self.client.get(url, {"op": "details"})
+        etag = response["ETag"]
+        lshw_result = self.make_lshw_result(node)
+        response = self.client.get(
+            url, {"op": "details"}, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(http.client.OK, response.status_code)
+        self.assertEqual(
+            {"lshw": lshw_result.stdout, "lldp": None},
+            bson.BSON(response.content).decode(),
+        )
+
     def test_GET_returns_not_found_when_node_does_not_exist(self):
         url = reverse("node_handler", args=["does-not-exist"])
         response = self.client.get(url, {"op": "details"})
@@ -23,12 +23,14 @@ from maasserver.enum import (
     NODE_TYPE_CHOICES,
 )
 from maasserver.exceptions import MAASAPIValidationError
+from maasserver.models import Node
 from maasserver.testing.api import APITestCase
 from maasserver.testing.factory import factory
 from maasserver.testing.fixtures import RBACEnabled
 from maasserver.utils import ignore_unused
 from maasserver.utils.django_urls import reverse
 from maasserver.utils.orm import reload_object
+from maastesting.djangotestcase import count_queries
 
 
 class TestIsRegisteredAnonAPI(APITestCase.ForAnonymousAndUserAndAdmin):
@@ -664,6 +666,48 @@ class TestNodesAPI(APITestCase.ForUser):
             "Node listing doesn't contain all node types.",
         )
 
+    def test_read_reuses_per_type_handler_results(self):
+        # Avoid circular imports.
+        from maasserver.api.devices import DevicesHandler
+        from maasserver.api.machines import MachinesHandler
+        from maasserver.api.rackcontrollers import RackControllersHandler
+        from maasserver.api.regioncontrollers import RegionControllersHandler
+
+        for _ in range(3):
+            factory.make_Node_with_Interface_on_Subnet(
+                with_dhcp_rack_primary=False
+            )
+            factory.make_Node_with_Interface_on_Subnet(
+                node_type=NODE_TYPE.DEVICE,
+                owner=self.user,
+                with_dhcp_rack_primary=False,
+            )
+        factory.make_RackController()
+        factory.make_RegionController()
+
+        def make_request():
+            request = factory.make_fake_request(reverse("nodes_handler"))
+            request.user = self.user
+            return request
+
+        per_type_queries = 0
+        for handler in [
+            DevicesHandler,
+            MachinesHandler,
+            RackControllersHandler,
+            RegionControllersHandler,
+        ]:
+            num_queries, _ = count_queries(handler().read, make_request())
+            per_type_queries += num_queries
+        num_queries, nodes = count_queries(
+            nodes_module.NodesHandler().read, make_request()
+        )
+
+        self.assertEqual(Node.objects.count(), len(nodes))
+        # The listing reuses the results of each per-type handler rather than
+        # evaluating their querysets a second time.
+        self.assertEqual(per_type_queries, num_queries)
+
     def test_GET_with_zone_filters_by_zone(self):
         non_listed_node = factory.make_Node(
             zone=factory.make_Zone(name="twilight")
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2019-10-15 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("maasserver", "0201_merge_20191008_1426")]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX maasserver_interface_node_mac_address_idx"
+            " ON maasserver_interface (mac_address)"
+            " WHERE (node_id IS NOT NULL)",
+            "DROP INDEX maasserver_interface_node_mac_address_idx",
+        )
+    ]
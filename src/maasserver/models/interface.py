@@ -14,10 +14,12 @@ __all__ = [
 
 from collections import OrderedDict
 from datetime import datetime
+from types import MappingProxyType
 from zlib import crc32
 
 from django.contrib.postgres.fields import ArrayField
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import connection, IntegrityError
 from django.db.models import (
     BooleanField,
     CASCADE,
@@ -34,7 +36,7 @@ from django.db.models import (
 from django.db.models.query import QuerySet
 from netaddr import AddrFormatError, EUI, IPAddress, IPNetwork
 
-from maasserver import DefaultMeta
+from maasserver import DefaultMeta, locks
 from maasserver.enum import (
     BRIDGE_TYPE,
     INTERFACE_LINK_TYPE,
@@ -55,7 +57,13 @@ from maasserver.fields import (
 from maasserver.models.cleansave import CleanSave
 from maasserver.models.staticipaddress import StaticIPAddress
 from maasserver.models.timestampedmodel import TimestampedModel
-from maasserver.utils.orm import get_one, MAASQueriesMixin
+from maasserver.utils.orm import (
+    get_one,
+    is_unique_violation,
+    MAASQueriesMixin,
+    request_transaction_retry,
+    savepoint,
+)
 from provisioningserver.logger import get_maas_logger
 from provisioningserver.utils.network import parse_integer
 
@@ -77,6 +85,52 @@ def get_subnet_family(subnet):
         return None
 
 
+def related_interfaces_cte(name, column, related_column, start):
+    """Return a recursive CTE, called `name`, of the ids of all interfaces
+    transitively related through `maasserver_interfacerelationship` to the
+    interfaces whose id matches the SQL condition `start`.
+
+    The relationships are followed from `column` to `related_column`, so
+    ("child_id", "parent_id") walks up to the ancestors and ("parent_id",
+    "child_id") walks down to the successors.
+    """
+    return """
+        {name}(id) AS (
+            SELECT {related_column}
+            FROM maasserver_interfacerelationship
+            WHERE {column} {start}
+          UNION
+            SELECT relationship.{related_column}
+            FROM maasserver_interfacerelationship AS relationship
+            JOIN {name} ON relationship.{column} = {name}.id
+        )
+    """.format(
+        name=name, column=column, related_column=related_column, start=start
+    )
+
+
+def get_related_interface_ids(interface_ids, column, related_column):
+    """Return the ids of all interfaces transitively related to
+    `interface_ids` through `maasserver_interfacerelationship`.
+
+    See `related_interfaces_cte` for `column` and `related_column`. The whole
+    closure is computed in a single query.
+    """
+    interface_ids = list(interface_ids)
+    if len(interface_ids) == 0:
+        return set()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "WITH RECURSIVE {related} SELECT id FROM related".format(
+                related=related_interfaces_cte(
+                    "related", column, related_column, "= ANY(%s)"
+                )
+            ),
+            [interface_ids],
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
 class InterfaceQueriesMixin(MAASQueriesMixin):
     def get_specifiers_q(self, specifiers, separator=":", **kwargs):
         """Returns a Q object for objects matching the given specifiers.
@@ -1139,18 +1193,17 @@ class Interface(CleanSave, TimestampedModel):
         )
         if len(links) > 0:
             # Ensure that LINK_UP only exists if no other links already exists.
-            link_ups = []
-            others = []
+            link_up_ids = []
+            has_others = False
             for link in links:
                 if link.alloc_type == IPADDRESS_TYPE.STICKY and (
                     link.ip is None or link.ip == ""
                 ):
-                    link_ups.append(link)
+                    link_up_ids.append(link.id)
                 else:
-                    others.append(link)
-            if len(link_ups) > 0 and len(others) > 0:
-                for link in link_ups:
-                    link.delete()
+                    has_others = True
+            if len(link_up_ids) > 0 and has_others:
+                StaticIPAddress.objects.filter(id__in=link_up_ids).delete()
         elif self.vlan is not None:
             # Use an associated subnet if it exists and its on the same VLAN
             # the interface is currently connected, else it will just be a
@@ -1164,18 +1217,6 @@ class Interface(CleanSave, TimestampedModel):
                 subnet = None
             self.link_subnet(INTERFACE_LINK_TYPE.LINK_UP, subnet)
 
-    def _unlink_static_ip(self, static_ip, swap_alloc_type=None):
-        """Unlink the STATIC IP address from the interface."""
-        # If the allocation type is only changing then we don't need to delete
-        # the IP address it needs to be updated.
-        if swap_alloc_type is not None:
-            static_ip.alloc_type = swap_alloc_type
-            static_ip.ip = None
-            static_ip.save()
-        else:
-            static_ip.delete()
-        return static_ip
-
     def unlink_ip_address(self, ip_address, clearing_config=False):
         """Remove the `IPAddress` link on interface.
 
@@ -1183,16 +1224,29 @@ class Interface(CleanSave, TimestampedModel):
             configuration for this interface is being cleared. This makes sure
             that the auto created link_up is not created.
         """
-        mode = ip_address.get_interface_link_type()
-        if mode == INTERFACE_LINK_TYPE.STATIC:
-            self._unlink_static_ip(ip_address)
-        else:
-            ip_address.delete()
+        ip_address.delete()
         # Always ensure that an interface that is enabled without any links
         # gets a LINK_UP link.
         if self.enabled and not clearing_config:
             self.ensure_link_up()
 
+    def unlink_ip_addresses(self, ip_addresses, clearing_config=False):
+        """Remove all the `ip_addresses` links on interface.
+
+        :param clearing_config: Set to True when the entire network
+            configuration for this interface is being cleared. This makes sure
+            that the auto created link_up is not created.
+        """
+        if len(ip_addresses) == 0:
+            return
+        # Unlinking any type of link deletes its IP address, so delete them
+        # all at once and only check for the LINK_UP afterwards.
+        StaticIPAddress.objects.filter(
+            id__in=[ip_address.id for ip_address in ip_addresses]
+        ).delete()
+        if self.enabled and not clearing_config:
+            self.ensure_link_up()
+
     def unlink_subnet_by_id(self, link_id):
         """Remove the `IPAddress` link on interface by its ID."""
         ip_address = self.ip_addresses.get(id=link_id)
@@ -1236,12 +1290,9 @@ class Interface(CleanSave, TimestampedModel):
                 return self._swap_subnet(
                     static_ip, subnet, ip_address=ip_address
                 )
-            else:
-                # Not staying in the same mode so we can just remove the
-                # static IP and change its alloc_type from STICKY.
-                static_ip = self._unlink_static_ip(
-                    static_ip, swap_alloc_type=new_alloc_type
-                )
+            # Not staying in the same mode so the static IP only needs its
+            # alloc_type changed from STICKY and its IP address removed. That
+            # is done, along with the subnet, in the single save below.
         elif mode == INTERFACE_LINK_TYPE.STATIC:
             # Linking to the subnet statically were the original was not a
             # static link. Swap the objects so the object keeps the same ID.
@@ -1263,14 +1314,17 @@ class Interface(CleanSave, TimestampedModel):
 
     def clear_all_links(self, clearing_config=False):
         """Remove all the `IPAddress` link on the interface."""
-        for ip_address in self.ip_addresses.exclude(
-            alloc_type=IPADDRESS_TYPE.DISCOVERED
-        ):
+        ip_addresses = list(
+            self.ip_addresses.exclude(alloc_type=IPADDRESS_TYPE.DISCOVERED)
+        )
+        if len(ip_addresses) == 0:
+            return
+        for ip_address in ip_addresses:
             maaslog.info(
                 "%s: IP address automatically unlinked: %s"
                 % (self.get_log_string(), ip_address)
             )
-            self.unlink_ip_address(ip_address, clearing_config=clearing_config)
+        self.unlink_ip_addresses(ip_addresses, clearing_config=clearing_config)
 
     def claim_auto_ips(self, temp_expires_after=None, exclude_addresses=None):
         """Claim IP addresses for this interfaces AUTO IP addresses.
@@ -1282,11 +1336,12 @@ class Interface(CleanSave, TimestampedModel):
         :param exclude_addresses: Exclude the following IP addresses in the
             allocation. Mainly used to ensure that the sub-transaction that
             runs to identify available IP address does not include the already
-            allocated IP addresses.
+            allocated IP addresses. When given as a set it is used as-is,
+            and the claimed addresses are added to it.
         """
         if exclude_addresses is None:
             exclude_addresses = set()
-        else:
+        elif not isinstance(exclude_addresses, set):
             exclude_addresses = set(exclude_addresses)
         assigned_addresses = []
         for auto_ip in self.ip_addresses.filter(
@@ -1318,24 +1373,31 @@ class Interface(CleanSave, TimestampedModel):
                 "without an associated subnet." % self.get_name()
             )
 
-        # Allocate a new IP address from the entire subnet, excluding already
-        # allocated addresses and ranges.
-        new_ip = StaticIPAddress.objects.allocate_new(
-            subnet=subnet,
-            alloc_type=IPADDRESS_TYPE.AUTO,
-            exclude_addresses=exclude_addresses,
+        # Pick a free IP address from the entire subnet, excluding already
+        # allocated addresses and ranges, and assign it to the existing AUTO
+        # address so that the interface link IDs remain consistent.
+        auto_ip.ip = subnet.get_next_ip_for_allocation(
+            exclude_addresses=exclude_addresses
         )
-        auto_ip.ip = new_ip.ip
-        # Throw away the newly-allocated address and assign it to the old AUTO
-        # address, so that the interface link IDs remain consistent.
-        new_ip.delete()
 
         # Set temp_expires_on when temp_expires_after is provided, meaning the
         # IP assignment is only temporary until the IP address can be
         # validated as free.
         if temp_expires_after is not None:
             auto_ip.temp_expires_on = datetime.utcnow() + temp_expires_after
-        auto_ip.save()
+
+        # The address is only known to be free in this transaction, so it
+        # can still be taken by the time it is saved. The same as
+        # `StaticIPAddress.objects.allocate_new`, retry with the allocation
+        # lock held when that happens.
+        try:
+            with savepoint():
+                auto_ip.save()
+        except IntegrityError as error:
+            if is_unique_violation(error):
+                request_transaction_retry(locks.address_allocation)
+            else:
+                raise
 
         # Only log the allocation when the assignment is not temporary. Its
         # the callers responsibility to log this information after the check
@@ -1422,43 +1484,107 @@ class Interface(CleanSave, TimestampedModel):
         # The order in which the creating and linkage between child and parent
         # is important. The IP addresses must first be moved from this
         # interface to the created bridge before the parent can be set on the
-        # bridge.
-        for sip in self.ip_addresses.all():
-            if sip.alloc_type != IPADDRESS_TYPE.DISCOVERED:
-                bridge.ip_addresses.add(sip)
-                self.ip_addresses.remove(sip)
+        # bridge. They are moved all at once, rather than one at a time, so
+        # the link rows are inserted and deleted in bulk while the
+        # `m2m_changed` handlers still see every moved address.
+        sips = list(
+            self.ip_addresses.exclude(alloc_type=IPADDRESS_TYPE.DISCOVERED)
+        )
+        if len(sips) > 0:
+            bridge.ip_addresses.add(*sips)
+            self.ip_addresses.remove(*sips)
         InterfaceRelationship(child=bridge, parent=self).save()
         return bridge
 
+    def _has_prefetched(self, name):
+        """Return whether the `name` relationships have been prefetched."""
+        return name in getattr(self, "_prefetched_objects_cache", {})
+
+    def _get_related(self, relationships, attr, column, related_column):
+        """Return all the interfaces transitively related to this one through
+        `relationships`, following `attr` on each relationship.
+
+        The graph is walked breadth-first through whatever relationships have
+        been prefetched, visiting each interface once. The closure of any
+        interface reached whose relationships haven't been prefetched is then
+        fetched in one go.
+        """
+        related = {}
+        unprefetched_ids = set()
+        frontier = [self]
+        while len(frontier) > 0:
+            next_frontier = []
+            for interface in frontier:
+                if interface._has_prefetched(relationships):
+                    for rel in getattr(interface, relationships).all():
+                        other = getattr(rel, attr)
+                        if other.id not in related:
+                            related[other.id] = other
+                            next_frontier.append(other)
+                elif interface.id is not None:
+                    unprefetched_ids.add(interface.id)
+            frontier = next_frontier
+        missing_ids = get_related_interface_ids(
+            unprefetched_ids, column, related_column
+        ).difference(related)
+        if len(missing_ids) > 0:
+            for interface in Interface.objects.filter(id__in=missing_ids):
+                related[interface.id] = interface
+        return set(related.values())
+
     def get_ancestors(self):
         """Returns all the ancestors of the interface (that is, including each
         parent's parents, and so on.)
         """
-        parents = set(rel.parent for rel in self.parent_relationships.all())
-        parent_relationships = set(self.parent_relationships.all())
-        for parent_rel in parent_relationships:
-            parents |= parent_rel.parent.get_ancestors()
-        return parents
+        return self._get_related(
+            "parent_relationships", "parent", "child_id", "parent_id"
+        )
 
     def get_successors(self):
         """Returns all the ancestors of the interface (that is, including each
         child's children, and so on.)
         """
-        children = set(rel.child for rel in self.children_relationships.all())
-        children_relationships = set(self.children_relationships.all())
-        for child_rel in children_relationships:
-            children |= child_rel.child.get_successors()
-        return children
+        return self._get_related(
+            "children_relationships", "child", "parent_id", "child_id"
+        )
 
     def get_all_related_interfaces(self):
         """Returns all of the related interfaces (including any ancestors,
-        successors, and ancestors' successors)."""
-        ancestors = self.get_ancestors()
-        all_related = set()
-        all_related |= ancestors
-        for ancestor in ancestors:
-            all_related |= ancestor.get_successors()
-        return all_related
+        successors, and ancestors' successors).
+
+        Unlike `get_ancestors` and `get_successors` this does not follow
+        prefetched relationships: the whole set is always loaded with a single
+        query.
+        """
+        if self.id is None:
+            return set()
+        # Walk up to the ancestors, then down from them to all of their
+        # successors, and load the interfaces, all in a single query.
+        return set(
+            Interface.objects.raw(
+                """
+                WITH RECURSIVE {ancestors}, {successors}
+                SELECT interface.*
+                FROM maasserver_interface AS interface
+                WHERE interface.id IN (
+                    SELECT id FROM ancestors
+                  UNION
+                    SELECT id FROM successors
+                )
+                """.format(
+                    ancestors=related_interfaces_cte(
+                        "ancestors", "child_id", "parent_id", "= %s"
+                    ),
+                    successors=related_interfaces_cte(
+                        "successors",
+                        "parent_id",
+                        "child_id",
+                        "IN (SELECT id FROM ancestors)",
+                    ),
+                ),
+                [self.id],
+            )
+        )
 
     def clean(self):
         super(Interface, self).clean()
@@ -1672,22 +1798,29 @@ class PhysicalInterface(Interface):
         if len(validation_errors) > 0:
             raise ValidationError(validation_errors)
 
-        # MAC address must be unique amongst every PhysicalInterface.
-        other_interfaces = PhysicalInterface.objects.filter(
-            mac_address=self.mac_address
-        )
-        if self.id is not None:
-            other_interfaces = other_interfaces.exclude(id=self.id)
-        other_interfaces = other_interfaces.all()
-        if len(other_interfaces) > 0:
-            raise ValidationError(
-                {
-                    "mac_address": [
-                        "This MAC address is already in use by %s."
-                        % (other_interfaces[0].get_log_string())
-                    ]
-                }
+        # MAC address must be unique amongst every PhysicalInterface. The
+        # database enforces this with a partial unique index, so this lookup
+        # is only to give a helpful error; skip it when neither the MAC
+        # address nor the type has changed since the interface was saved.
+        if self.id is None or self._state.has_any_changed(
+            ["mac_address", "type"]
+        ):
+            # Only the first offending interface is needed for the error.
+            other_interfaces = PhysicalInterface.objects.filter(
+                mac_address=self.mac_address
             )
+            if self.id is not None:
+                other_interfaces = other_interfaces.exclude(id=self.id)
+            other_interface = other_interfaces.select_related("node").first()
+            if other_interface is not None:
+                raise ValidationError(
+                    {
+                        "mac_address": [
+                            "This MAC address is already in use by %s."
+                            % (other_interface.get_log_string())
+                        ]
+                    }
+                )
 
         # No parents are allow for a physical interface.
         if self.id is not None:
@@ -1735,13 +1868,13 @@ class ChildInterface(Interface):
         if self.id is None:
             return True
         else:
-            if self.parents.count() > 0:
-                is_enabled = {
-                    parent.is_enabled()
-                    for parent in self.parents.all()
-                    if parent != self
-                }
-                return True in is_enabled
+            # Use the precache so less queries are made, and stop at the
+            # first enabled parent.
+            parents = self.parents.all()
+            if len(parents) > 0:
+                return any(
+                    parent.is_enabled() for parent in parents if parent != self
+                )
             else:
                 return self.enabled
 
@@ -1756,7 +1889,10 @@ class ChildInterface(Interface):
         # Parent interfaces on this bond must be from the same node and can
         # only be physical interfaces.
         if self.id is not None:
-            nodes = {parent.node for parent in self.parents.all()}
+            # Use the precache so less queries are made, and only load the
+            # parents once for both checks.
+            parents = self.parents.all()
+            nodes = {parent.node_id for parent in parents}
             if len(nodes) > 1:
                 raise ValidationError(
                     {
@@ -1765,7 +1901,7 @@ class ChildInterface(Interface):
                         ]
                     }
                 )
-            parent_types = {parent.get_type() for parent in self.parents.all()}
+            parent_types = {parent.get_type() for parent in parents}
             self._validate_acceptable_parent_types(parent_types)
 
     def _validate_unique_or_parent_mac(self):
@@ -1775,35 +1911,52 @@ class ChildInterface(Interface):
         # done before it would always fail. As the validation would see that
         # its soon to be parents MAC address is already in use.
         if self.id is not None:
-            interfaces = Interface.objects.filter(mac_address=self.mac_address)
             related_ids = [
                 parent.id for parent in self.get_all_related_interfaces()
             ]
-            bad_interfaces = []
-            for interface in interfaces:
-                if self.id == interface.id:
-                    # Self in database so ignore.
-                    continue
-                elif interface.id in related_ids:
-                    # Found the same MAC on either a parent, a child, or
-                    # another of the parents' children.
-                    continue
-                else:
-                    # Its not unique and its not a parent interface if we
-                    # made it this far.
-                    bad_interfaces.append(interface)
-            if len(bad_interfaces) > 0:
+            # Ignore self, and the same MAC on either a parent, a child, or
+            # another of the parents' children. Anything left is not unique
+            # and not a parent interface.
+            bad_interface = (
+                Interface.objects.filter(mac_address=self.mac_address)
+                .exclude(id=self.id)
+                .exclude(id__in=related_ids)
+                .select_related("node")
+                .first()
+            )
+            if bad_interface is not None:
                 maaslog.warning(
                     "While adding %s: "
                     "found a MAC address already in use by %s."
-                    % (
-                        self.get_log_string(),
-                        bad_interfaces[0].get_log_string(),
-                    )
+                    % (self.get_log_string(), bad_interface.get_log_string())
                 )
 
+    def save(self, *args, **kwargs):
+        # Set the node of this interface to the same as its parents.
+        self.node = self.get_node()
+        # Set the enabled status based on its parents.
+        self.enabled = self.is_enabled()
+        return super(ChildInterface, self).save(*args, **kwargs)
+
+
+class BondOrBridgeMixin:
+    """Validation shared by bond and bridge interfaces.
+
+    Subclasses only need to provide `_validate_acceptable_parent_types`.
+    """
+
+    def clean(self):
+        super().clean()
+        # Validate that the MAC address is not None.
+        if not self.mac_address:
+            raise ValidationError(
+                {"mac_address": ["This field cannot be blank."]}
+            )
+        self._validate_parent_interfaces()
+        self._validate_unique_or_parent_mac()
+
 
-class BridgeInterface(ChildInterface):
+class BridgeInterface(BondOrBridgeMixin, ChildInterface):
     class Meta(Interface.Meta):
         proxy = True
         verbose_name = "Bridge"
@@ -1820,25 +1973,8 @@ class BridgeInterface(ChildInterface):
                 {"parents": ["Bridges cannot contain other bridges."]}
             )
 
-    def clean(self):
-        super().clean()
-        # Validate that the MAC address is not None.
-        if not self.mac_address:
-            raise ValidationError(
-                {"mac_address": ["This field cannot be blank."]}
-            )
-        self._validate_parent_interfaces()
-        self._validate_unique_or_parent_mac()
-
-    def save(self, *args, **kwargs):
-        # Set the node of this bond to the same as its parents.
-        self.node = self.get_node()
-        # Set the enabled status based on its parents.
-        self.enabled = self.is_enabled()
-        super().save(*args, **kwargs)
 
-
-class BondInterface(ChildInterface):
+class BondInterface(BondOrBridgeMixin, ChildInterface):
     class Meta(Interface.Meta):
         proxy = True
         verbose_name = "Bond"
@@ -1848,17 +1984,6 @@ class BondInterface(ChildInterface):
     def get_type(self):
         return INTERFACE_TYPE.BOND
 
-    def clean(self):
-        super(BondInterface, self).clean()
-        # Validate that the MAC address is not None.
-        if not self.mac_address:
-            raise ValidationError(
-                {"mac_address": ["This field cannot be blank."]}
-            )
-
-        self._validate_parent_interfaces()
-        self._validate_unique_or_parent_mac()
-
     def _validate_acceptable_parent_types(self, parent_types):
         """Validates that bonds only include physical interfaces."""
         if parent_types != {INTERFACE_TYPE.PHYSICAL}:
@@ -1866,13 +1991,6 @@ class BondInterface(ChildInterface):
                 {"parents": ["Only physical interfaces can be bonded."]}
             )
 
-    def save(self, *args, **kwargs):
-        # Set the node of this bond to the same as its parents.
-        self.node = self.get_node()
-        # Set the enabled status based on its parents.
-        self.enabled = self.is_enabled()
-        super(BondInterface, self).save(*args, **kwargs)
-
 
 def build_vlan_interface_name(parent, vlan):
     if parent:
@@ -1982,10 +2100,6 @@ class VLANInterface(ChildInterface):
         return self.get_node().is_controller
 
     def save(self, *args, **kwargs):
-        # Set the node of this VLAN to the same as its parents.
-        self.node = self.get_node()
-        # Set the enabled status based on its parents.
-        self.enabled = self.is_enabled()
         # Set the MAC address to the same as its parent.
         if self.id is not None:
             parent = self.parents.first()
@@ -2033,12 +2147,12 @@ class UnknownInterface(Interface):
         )
         if self.id is not None:
             other_interfaces = other_interfaces.exclude(id=self.id)
-        other_interfaces = other_interfaces.all()
-        if len(other_interfaces) > 0:
+        other_interface = other_interfaces.select_related("node").first()
+        if other_interface is not None:
             maaslog.warning(
                 "While adding %s: "
                 "found a MAC address already in use by %s."
-                % (self.get_log_string(), other_interfaces[0].get_log_string())
+                % (self.get_log_string(), other_interface.get_log_string())
             )
 
         # Cannot have any parents.
@@ -2051,15 +2165,17 @@ class UnknownInterface(Interface):
                 )
 
 
-INTERFACE_TYPE_MAPPING = {
-    klass.get_type(): klass
-    for klass in [
-        PhysicalInterface,
-        BondInterface,
-        BridgeInterface,
-        VLANInterface,
-        UnknownInterface,
-    ]
-}
+INTERFACE_TYPE_MAPPING = MappingProxyType(
+    {
+        klass.get_type(): klass
+        for klass in [
+            PhysicalInterface,
+            BondInterface,
+            BridgeInterface,
+            VLANInterface,
+            UnknownInterface,
+        ]
+    }
+)
 
-ALL_INTERFACE_TYPES = set(INTERFACE_TYPE_MAPPING.values())
+ALL_INTERFACE_TYPES = frozenset(INTERFACE_TYPE_MAPPING.values())
@@ -4242,9 +4242,9 @@ class Node(CleanSave, TimestampedModel):
                 temp_expires_after=temp_expires_after,
                 exclude_addresses=exclude_addresses,
             )
-            for ip in claimed_ips:
-                exclude_addresses.add(str(ip.ip))
-                allocated_ips.add(ip)
+            # The claimed IPs are added to `exclude_addresses` as they
+            # are claimed.
+            allocated_ips.update(claimed_ips)
         return allocated_ips
 
     def _claim_auto_ips(self, defer):
@@ -6276,10 +6276,7 @@ class Controller(Node):
                     if not created:
                         # Interface already existed so remove all assigned IP
                         # addresses.
-                        for ip_address in interface.ip_addresses.exclude(
-                            alloc_type=IPADDRESS_TYPE.DISCOVERED
-                        ):
-                            interface.unlink_ip_address(ip_address)
+                        interface.clear_all_links()
                     maaslog.error(
                         "Unable to correctly identify VLAN for interface '%s' "
                         "on controller '%s'. Placing interface on VLAN "
@@ -6613,8 +6610,7 @@ class Controller(Node):
 
         # Remove all the current IP address that no longer apply to this
         # interface.
-        for ip_address in current_ip_addresses:
-            interface.unlink_ip_address(ip_address)
+        interface.unlink_ip_addresses(current_ip_addresses)
 
         return updated_ip_addresses
 
@@ -1313,6 +1313,73 @@ class InterfaceTest(MAASServerTestCase):
             Equals({eth0, eth0_100, eth0_101, br0}),
         )
 
+    def test_get_all_related_interfaces_queries_once(self):
+        node = factory.make_Node()
+        eth0 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        eth0_100 = factory.make_Interface(
+            INTERFACE_TYPE.VLAN, node=node, parents=[eth0]
+        )
+        br0 = factory.make_Interface(
+            INTERFACE_TYPE.BRIDGE, node=node, parents=[eth0_100]
+        )
+        br0 = reload_object(br0)
+        counter = CountQueries()
+        with counter:
+            related = br0.get_all_related_interfaces()
+        self.assertThat(related, Equals({eth0, eth0_100, br0}))
+        self.assertThat(counter.num_queries, Equals(1))
+
+    def test_get_ancestors_uses_constant_queries_regardless_of_depth(self):
+        node = factory.make_Node()
+        eth0 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        eth0_100 = factory.make_Interface(
+            INTERFACE_TYPE.VLAN, node=node, parents=[eth0]
+        )
+        br0 = factory.make_Interface(
+            INTERFACE_TYPE.BRIDGE, node=node, parents=[eth0_100]
+        )
+        br0 = reload_object(br0)
+        counter = CountQueries()
+        with counter:
+            ancestors = br0.get_ancestors()
+        self.assertThat(ancestors, Equals({eth0, eth0_100}))
+        # One query for the closure and one to load the interfaces.
+        self.assertThat(counter.num_queries, Equals(2))
+
+    def test_get_successors_uses_constant_queries_regardless_of_depth(self):
+        node = factory.make_Node()
+        eth0 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        eth0_100 = factory.make_Interface(
+            INTERFACE_TYPE.VLAN, node=node, parents=[eth0]
+        )
+        br0 = factory.make_Interface(
+            INTERFACE_TYPE.BRIDGE, node=node, parents=[eth0_100]
+        )
+        eth0 = reload_object(eth0)
+        counter = CountQueries()
+        with counter:
+            successors = eth0.get_successors()
+        self.assertThat(successors, Equals({eth0_100, br0}))
+        self.assertThat(counter.num_queries, Equals(2))
+
+    def test_get_ancestors_follows_prefetched_relationships(self):
+        node = factory.make_Node()
+        eth0 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        eth1 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        bond0 = factory.make_Interface(
+            INTERFACE_TYPE.BOND, node=node, parents=[eth0, eth1]
+        )
+        bond0 = Interface.objects.prefetch_related(
+            "parent_relationships__parent"
+        ).get(id=bond0.id)
+        counter = CountQueries()
+        with counter:
+            ancestors = bond0.get_ancestors()
+        self.assertThat(ancestors, Equals({eth0, eth1}))
+        # The parents were prefetched, so only their own parents need to be
+        # looked up, once for both of them.
+        self.assertThat(counter.num_queries, Equals(1))
+
     def test_add_tag_adds_new_tag(self):
         interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, tags=[])
         tag = factory.make_name("tag")
@@ -1610,6 +1677,29 @@ class TestPhysicalInterface(MAASServerTestCase):
             error.message_dict,
         )
 
+    def test_mac_address_must_be_unique_when_changed(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        bad_interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        bad_interface.mac_address = interface.mac_address
+        error = self.assertRaises(ValidationError, bad_interface.save)
+        self.assertEqual(
+            {
+                "mac_address": [
+                    "This MAC address is already in use by %s."
+                    % (interface.get_log_string())
+                ]
+            },
+            error.message_dict,
+        )
+
+    def test_mac_address_not_checked_when_unchanged(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        interface = reload_object(interface)
+        mock_filter = self.patch(PhysicalInterface.objects, "filter")
+        interface.enabled = not interface.enabled
+        interface.save()
+        self.assertThat(mock_filter, MockNotCalled())
+
     def test_cannot_have_parents(self):
         parent = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
         error = self.assertRaises(
@@ -2115,6 +2205,38 @@ class BondInterfaceTest(MAASServerTestCase):
         self.assertFalse(interface.is_enabled())
         self.assertFalse(reload_object(interface).enabled)
 
+    def test_is_enabled_uses_prefetched_parents(self):
+        node = factory.make_Node()
+        parent1 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        parent2 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        interface = factory.make_Interface(
+            INTERFACE_TYPE.BOND,
+            mac_address=factory.make_mac_address(),
+            parents=[parent1, parent2],
+        )
+        interface = Interface.objects.prefetch_related("parents").get(
+            id=interface.id
+        )
+        counter = CountQueries()
+        with counter:
+            self.assertTrue(interface.is_enabled())
+        self.assertThat(counter.num_queries, Equals(0))
+
+    def test_is_enabled_queries_parents_once(self):
+        node = factory.make_Node()
+        parent1 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        parent2 = factory.make_Interface(INTERFACE_TYPE.PHYSICAL, node=node)
+        interface = factory.make_Interface(
+            INTERFACE_TYPE.BOND,
+            mac_address=factory.make_mac_address(),
+            parents=[parent1, parent2],
+        )
+        interface = reload_object(interface)
+        counter = CountQueries()
+        with counter:
+            self.assertTrue(interface.is_enabled())
+        self.assertThat(counter.num_queries, Equals(1))
+
 
 class BridgeInterfaceTest(MAASServerTestCase):
     def test_manager_returns_bridge_interfaces(self):
@@ -2971,6 +3093,106 @@ class TestUnlinkIPAddress(MAASServerTestCase):
         self.assertThat(mock_ensure_link_up, MockNotCalled())
 
 
+class TestUnlinkIPAddresses(MAASServerTestCase):
+    """Tests for `Interface.unlink_ip_addresses`."""
+
+    def make_links(self, interface, count=3):
+        subnet = factory.make_Subnet(vlan=interface.vlan)
+        return [
+            factory.make_StaticIPAddress(
+                alloc_type=IPADDRESS_TYPE.AUTO,
+                ip="",
+                subnet=subnet,
+                interface=interface,
+            )
+            for _ in range(count)
+        ]
+
+    def test__deletes_links_and_ensures_link_up_once(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        ip_addresses = self.make_links(interface)
+        ensure_link_up = interface.ensure_link_up
+        mock_ensure_link_up = self.patch(interface, "ensure_link_up")
+        mock_ensure_link_up.side_effect = ensure_link_up
+        interface.unlink_ip_addresses(ip_addresses)
+        for ip_address in ip_addresses:
+            self.assertIsNone(reload_object(ip_address))
+        self.assertThat(mock_ensure_link_up, MockCalledOnceWith())
+        self.assertThat(
+            [
+                ip_address.get_interface_link_type()
+                for ip_address in interface.ip_addresses.all()
+            ],
+            Equals([INTERFACE_LINK_TYPE.LINK_UP]),
+        )
+
+    def test__doesnt_call_ensure_link_up_if_clearing_config(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        ip_addresses = self.make_links(interface)
+        mock_ensure_link_up = self.patch_autospec(interface, "ensure_link_up")
+        interface.unlink_ip_addresses(ip_addresses, clearing_config=True)
+        for ip_address in ip_addresses:
+            self.assertIsNone(reload_object(ip_address))
+        self.assertThat(mock_ensure_link_up, MockNotCalled())
+
+    def test__does_nothing_without_ip_addresses(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        mock_ensure_link_up = self.patch_autospec(interface, "ensure_link_up")
+        interface.unlink_ip_addresses([])
+        self.assertThat(mock_ensure_link_up, MockNotCalled())
+
+
+class TestClearAllLinks(MAASServerTestCase):
+    """Tests for `Interface.clear_all_links`."""
+
+    def make_links(self, interface):
+        subnet = factory.make_Subnet(vlan=interface.vlan)
+        auto_ip = factory.make_StaticIPAddress(
+            alloc_type=IPADDRESS_TYPE.AUTO,
+            ip="",
+            subnet=subnet,
+            interface=interface,
+        )
+        static_ip = factory.make_StaticIPAddress(
+            alloc_type=IPADDRESS_TYPE.STICKY,
+            ip=factory.pick_ip_in_Subnet(subnet),
+            subnet=subnet,
+            interface=interface,
+        )
+        discovered_ip = factory.make_StaticIPAddress(
+            alloc_type=IPADDRESS_TYPE.DISCOVERED,
+            ip=factory.pick_ip_in_Subnet(subnet, but_not=[static_ip.ip]),
+            subnet=subnet,
+            interface=interface,
+        )
+        return auto_ip, static_ip, discovered_ip
+
+    def test__removes_all_but_discovered_links(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        auto_ip, static_ip, discovered_ip = self.make_links(interface)
+        interface.clear_all_links(clearing_config=True)
+        self.assertIsNone(reload_object(auto_ip))
+        self.assertIsNone(reload_object(static_ip))
+        self.assertIsNotNone(reload_object(discovered_ip))
+        self.assertItemsEqual(
+            [discovered_ip], reload_object(interface).ip_addresses.all()
+        )
+
+    def test__leaves_LINK_UP_when_not_clearing_config(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        self.make_links(interface)
+        interface.clear_all_links()
+        self.assertThat(
+            [
+                ip_address.get_interface_link_type()
+                for ip_address in interface.ip_addresses.exclude(
+                    alloc_type=IPADDRESS_TYPE.DISCOVERED
+                )
+            ],
+            Equals([INTERFACE_LINK_TYPE.LINK_UP]),
+        )
+
+
 class TestUnlinkSubnet(MAASServerTestCase):
     """Tests for `Interface.unlink_subnet`."""
 
@@ -3287,6 +3509,24 @@ class TestUpdateIPAddress(MAASTransactionServerTestCase):
         self.assertEqual(new_subnet, static_ip.subnet)
         self.assertIsNone(static_ip.ip)
 
+    def test__switch_static_to_other_mode_saves_once(self):
+        interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+        subnet = factory.make_Subnet(vlan=interface.vlan)
+        static_ip = factory.make_StaticIPAddress(
+            alloc_type=IPADDRESS_TYPE.STICKY,
+            ip=factory.pick_ip_in_Subnet(subnet),
+            subnet=subnet,
+            interface=interface,
+        )
+        save = StaticIPAddress.save
+        mock_save = self.patch_autospec(StaticIPAddress, "save")
+        mock_save.side_effect = save
+        mode = random.choice(
+            [INTERFACE_LINK_TYPE.AUTO, INTERFACE_LINK_TYPE.DHCP]
+        )
+        interface.update_ip_address(static_ip, mode, subnet)
+        self.assertThat(mock_save, MockCalledOnceWith(static_ip))
+
     def test__switch_static_to_link_up(self):
         interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
         subnet = factory.make_Subnet(vlan=interface.vlan)
@@ -3539,6 +3779,26 @@ class TestClaimAutoIPs(MAASTransactionServerTestCase):
             auto_ip_ids, (ip.id for ip in assigned_addresses)
         )
 
+    def test__does_not_create_or_delete_ip_addresses(self):
+        with transaction.atomic():
+            interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+            for _ in range(3):
+                subnet = factory.make_ipv4_Subnet_with_IPRanges(
+                    vlan=interface.vlan
+                )
+                factory.make_StaticIPAddress(
+                    alloc_type=IPADDRESS_TYPE.AUTO,
+                    ip="",
+                    subnet=subnet,
+                    interface=interface,
+                )
+            ip_ids = set(StaticIPAddress.objects.values_list("id", flat=True))
+        with transaction.atomic():
+            interface.claim_auto_ips()
+        self.assertEqual(
+            ip_ids, set(StaticIPAddress.objects.values_list("id", flat=True))
+        )
+
     def test__claims_all_missing_assigned_auto_ip_addresses(self):
         with transaction.atomic():
             interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
@@ -3674,6 +3934,23 @@ class TestClaimAutoIPs(MAASTransactionServerTestCase):
             )
         self.assertNotEqual(IPAddress(exclude), IPAddress(auto_ip.ip))
 
+    def test__adds_claimed_ip_addresses_to_exclude_addresses(self):
+        with transaction.atomic():
+            interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
+            subnet = factory.make_Subnet(vlan=interface.vlan)
+            factory.make_StaticIPAddress(
+                alloc_type=IPADDRESS_TYPE.AUTO,
+                ip="",
+                subnet=subnet,
+                interface=interface,
+            )
+        exclude_addresses = set()
+        with transaction.atomic():
+            observed = interface.claim_auto_ips(
+                exclude_addresses=exclude_addresses
+            )
+        self.assertEqual({str(ip.ip) for ip in observed}, exclude_addresses)
+
     def test__can_acquire_multiple_address_from_the_same_subnet(self):
         with transaction.atomic():
             interface = factory.make_Interface(INTERFACE_TYPE.PHYSICAL)
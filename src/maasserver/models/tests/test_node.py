@@ -6979,30 +6979,17 @@ class TestNodeNetworking(MAASTransactionServerTestCase):
         auto_ip = factory.make_StaticIPAddress(
             alloc_type=IPADDRESS_TYPE.AUTO, ip="", interface=nic1
         )
-        mock_unlink_ip_address = self.patch_autospec(
-            Interface, "unlink_ip_address"
-        )
         node._clear_networking_configuration()
-        # Since the interfaces are not ordered, which they dont need to be
-        # we extract the passed interface to each call.
-        observed_interfaces = set(
-            call[0][0] for call in mock_unlink_ip_address.call_args_list
-        )
-        # Since the IP address are not ordered, which they dont need to be
-        # we extract the passed IP address to each call.
-        observed_ip_address = [
-            call[0][1] for call in mock_unlink_ip_address.call_args_list
-        ]
-        # Check that clearing_config is always sent as true.
-        clearing_config = set(
-            call[1]["clearing_config"]
-            for call in mock_unlink_ip_address.call_args_list
-        )
-        self.assertItemsEqual([nic0, nic1], observed_interfaces)
+        # All the links are deleted and, since the whole configuration is
+        # being cleared, no LINK_UP is created in their place.
         self.assertItemsEqual(
-            [dhcp_ip, static_ip, auto_ip], observed_ip_address
+            [],
+            StaticIPAddress.objects.filter(
+                id__in=[dhcp_ip.id, static_ip.id, auto_ip.id]
+            ),
         )
-        self.assertEqual(set([True]), clearing_config)
+        self.assertItemsEqual([], nic0.ip_addresses.all())
+        self.assertItemsEqual([], nic1.ip_addresses.all())
 
     def test__clear_networking_configuration_clears_gateways(self):
         node = factory.make_Node()
@@ -10680,6 +10667,46 @@ class TestUpdateInterfaces(MAASServerTestCase, UpdateInterfacesMixin):
         for extra_ip in extra_ips:
             self.expectThat(reload_object(extra_ip), Is(None))
 
+    def test__existing_physical_removes_old_links_then_links_up_once(self):
+        controller = self.create_empty_controller()
+        vlan = factory.make_VLAN()
+        subnet = factory.make_Subnet(vlan=vlan)
+        interface = factory.make_Interface(
+            INTERFACE_TYPE.PHYSICAL, node=controller, vlan=vlan
+        )
+        old_ips = [
+            factory.make_StaticIPAddress(
+                alloc_type=IPADDRESS_TYPE.AUTO,
+                subnet=subnet,
+                interface=interface,
+            )
+            for _ in range(3)
+        ]
+        interfaces = {
+            "eth0": {
+                "type": "physical",
+                "mac_address": interface.mac_address,
+                "parents": [],
+                "links": [],
+                "enabled": True,
+            }
+        }
+        ensure_link_up = Interface.ensure_link_up
+        mock_ensure_link_up = self.patch_autospec(Interface, "ensure_link_up")
+        mock_ensure_link_up.side_effect = ensure_link_up
+        self.update_interfaces(controller, interfaces)
+        self.assertThat(mock_ensure_link_up, MockCalledOnceWith(interface))
+        for old_ip in old_ips:
+            self.expectThat(reload_object(old_ip), Is(None))
+        addresses = list(interface.ip_addresses.all())
+        self.assertThat(addresses, HasLength(1))
+        self.assertThat(
+            addresses[0],
+            MatchesStructure.byEquality(
+                alloc_type=IPADDRESS_TYPE.STICKY, ip=None
+            ),
+        )
+
     def test__existing_physical_with_links_new_vlan_no_links(self):
         controller = self.create_empty_controller()
         fabric = factory.make_Fabric()